@@ -13,17 +13,21 @@
 
 import cv2
 import numpy as np
-from PIL import ImageGrab
+import mss
+import wmi
 import time
 import os
 import socket
 import configparser
 import logging
 import logging.handlers # 新增: 用于日志滚动
-import pyautogui
 import sys
-import requests
 import shutil
+import signal
+import threading
+import ctypes
+from ctypes import wintypes
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 # --- 路径解析辅助函数 ---
 
@@ -105,6 +109,81 @@ def find_and_prepare_config_path():
 LOG_FILE = 'monitor.log'
 LOG_MAX_SIZE_MB = 5  # 日志文件最大体积（MB）
 
+# 模板缓存: 模板路径 -> 模板数据字典 (彩色图、灰度图、尺寸及预处理结果)。
+# 每个模板只解码一次，诊断循环中直接复用。
+_TEMPLATE_CACHE = {}
+
+# 粗到细匹配参数: 先在缩小的灰度图上粗略定位，再在原分辨率的小区域内精确匹配
+COARSE_SCALES = (4, 2)          # 候选缩小倍数 (须为 2 的幂，逐级 pyrDown 得到)，优先使用更大的倍数
+COARSE_MIN_TEMPLATE_SIDE = 8    # 缩小后模板的最短边不得小于此值，否则不做粗匹配
+COARSE_THRESHOLD_RELAX = 0.1    # 粗匹配阶段相对正式阈值放宽的幅度
+COARSE_ROI_MARGIN = 8           # 精匹配区域在候选位置四周额外保留的像素
+
+# 模板面积超过此值时改用频域 (DFT) 匹配: 空域卷积为 O(W·H·w·h)，频域为 O(W·H·log(W·H))
+FFT_MIN_TEMPLATE_AREA = 18 * 18
+
+# 画面变化检测参数: 在缩小后的灰度图上比较，逐像素最大差值不超过阈值时视为画面未变化
+FRAME_DIFF_SCALE = 8            # 比较前的缩小倍数
+FRAME_DIFF_MAX = 2              # 允许的最大灰度差 (容忍轻微噪声)
+
+# Win32 进程快照相关常量与结构体 (用于 get_process_count)
+TH32CS_SNAPPROCESS = 0x00000002
+INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+
+class PROCESSENTRY32W(ctypes.Structure):
+    _fields_ = [
+        ('dwSize', wintypes.DWORD),
+        ('cntUsage', wintypes.DWORD),
+        ('th32ProcessID', wintypes.DWORD),
+        ('th32DefaultHeapID', ctypes.c_size_t),
+        ('th32ModuleID', wintypes.DWORD),
+        ('cntThreads', wintypes.DWORD),
+        ('th32ParentProcessID', wintypes.DWORD),
+        ('pcPriClassBase', wintypes.LONG),
+        ('dwFlags', wintypes.DWORD),
+        ('szExeFile', wintypes.WCHAR * wintypes.MAX_PATH),
+    ]
+
+
+# 进程快照所用的 kernel32 函数原型，只在导入时声明一次。
+# 使用独立的 WinDLL 实例，不修改进程内共享的 ctypes.windll.kernel32 上的函数原型
+_KERNEL32 = ctypes.WinDLL('kernel32', use_last_error=True)
+_KERNEL32.CreateToolhelp32Snapshot.restype = wintypes.HANDLE
+_KERNEL32.CreateToolhelp32Snapshot.argtypes = [wintypes.DWORD, wintypes.DWORD]
+_KERNEL32.Process32FirstW.restype = wintypes.BOOL
+_KERNEL32.Process32FirstW.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESSENTRY32W)]
+_KERNEL32.Process32NextW.restype = wintypes.BOOL
+_KERNEL32.Process32NextW.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESSENTRY32W)]
+_KERNEL32.CloseHandle.restype = wintypes.BOOL
+_KERNEL32.CloseHandle.argtypes = [wintypes.HANDLE]
+
+# 鼠标点击所用的 mouse_event 标志 (用于 click_at)
+MOUSEEVENTF_LEFTDOWN = 0x0002
+MOUSEEVENTF_LEFTUP = 0x0004
+
+# 多模板并行匹配的线程池 (cv2.matchTemplate 运算期间会释放 GIL)
+MATCH_WORKERS = min(8, os.cpu_count() or 1)
+_POOL = ThreadPoolExecutor(max_workers=MATCH_WORKERS)
+
+# 是否使用 OpenCL (cv2.UMat) 执行 matchTemplate，由配置 EnableOpenCL 和设备支持情况共同决定
+_USE_OPENCL = False
+
+# 是否使用 CUDA (cv2.cuda) 执行 matchTemplate，由配置 EnableCUDA 和设备支持情况共同决定，优先于 OpenCL
+_USE_CUDA = False
+
+# mss 截图实例，首次截图时创建，之后复用 (避免每次截图都重新创建设备上下文)
+_SCT = None
+
+# 主循环等待期间检查退出请求的间隔 (秒)，决定收到退出信号后的最长响应时间
+STOP_CHECK_INTERVAL = 1
+
+# 本机 IP，首次成功获取后缓存 (每次告警和 Webhook 都会用到，运行期间不会变化)
+_LOCAL_IP = None
+
+# 按截图尺寸复用的灰度图缓冲区，避免每次截图都分配新的内存
+_GRAY_BUFFERS = {}
+
 # ==============================================================================
 # --- 1. 初始化与配置模块 ---
 # ==============================================================================
@@ -144,6 +223,57 @@ def setup_logging():
     logger.addHandler(file_handler)
 
 
+class ShareAlertFileHandler(logging.FileHandler):
+    """
+    写入网络共享文件夹的告警日志处理器。
+    写入或打开文件失败时把错误记录到主日志 (--noconsole 打包后没有 stderr，默认的 handleError 会静默丢失)，
+    并关闭已失效的文件句柄，下一条告警会重新打开文件，共享恢复后即可继续写入。
+    """
+
+    def emit(self, record):
+        try:
+            # FileHandler.emit 中打开文件的异常不会经过 handleError，这里统一处理
+            super().emit(record)
+        except Exception:
+            self.handleError(record)
+
+    def handleError(self, record):
+        error = sys.exc_info()[1]
+        stream, self.stream = self.stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except OSError:
+                pass
+        logging.error(f"写入共享告警日志 '{self.baseFilename}' 失败: {error} (告警内容: {record.getMessage()})")
+
+
+def setup_alert_logger(config):
+    """
+    配置写入网络共享文件夹的告警日志 (logger 名为 'alert')。
+    文件只在首次写入时打开并一直保持，避免每条告警都在网络共享上重新打开/关闭文件；
+    写入失败时记录到主日志，并在下一条告警时重新打开文件 (见 ShareAlertFileHandler)。
+    未启用或未配置共享路径时，告警日志被静默丢弃。
+    """
+    alert_logger = logging.getLogger('alert')
+    alert_logger.setLevel(logging.INFO)
+    alert_logger.propagate = False
+    alert_logger.handlers.clear()
+
+    share_path = config.get('alertsharepath')
+    if not config.get('enablealertsharelog') or not share_path:
+        alert_logger.addHandler(logging.NullHandler())
+        return alert_logger
+
+    local_ip = get_local_ip()
+    alert_filepath = os.path.join(share_path, f"{local_ip}_VISUAL_HISTORY.log")
+    handler = ShareAlertFileHandler(alert_filepath, encoding='utf-8', delay=True)
+    handler.setFormatter(logging.Formatter(f'[%(asctime)s] - IP: {local_ip} - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    alert_logger.addHandler(handler)
+    logging.info(f"告警日志将写入: {alert_filepath}")
+    return alert_logger
+
+
 def load_config(config_path):
     """
     从指定的 .ini 文件加载所有配置，并进行类型转换。
@@ -182,7 +312,7 @@ def load_config(config_path):
     # 类型转换，带默认值以增加健壮性
     int_keys = ['requiredprocesscount', 'requiredsuccesscount', 'loopinterval', 'timeoutseconds', 'clickoffsetx', 'clickoffsety', 'clickretrydelay', 'loginclickdelay']
     float_keys = ['stucktemplatethreshold', 'successtemplatethreshold', 'logintemplatethreshold', 'minimizebuttontemplatethreshold', 'specialtemplatethreshold']
-    bool_keys = ['enableclick', 'enablestuckareasearch', 'enablesuccessareasearch', 'savestuckscreenshot', 'enableloginscreencheck', 'enablewebhooknotification', 'enablespecialcheck']
+    bool_keys = ['enableclick', 'enablestuckareasearch', 'enablesuccessareasearch', 'savestuckscreenshot', 'enableloginscreencheck', 'enablewebhooknotification', 'enablespecialcheck', 'successfastmatch', 'enableopencl', 'enablealertsharelog', 'enablecolormatch', 'enablecuda']
 
     for key in int_keys:
         cfg[key] = int(cfg.get(key, 0))
@@ -208,7 +338,7 @@ def load_config(config_path):
     cfg['templateloginimagename'] = get_template_path(cfg.get('templateloginimagename', ''))
     cfg['templateminimizebuttonimagename'] = get_template_path(cfg.get('templateminimizebuttonimagename', ''))
     cfg['templatespecialimagename'] = get_template_path(cfg.get('templatespecialimagename', ''))
-    
+
     # 解析区域截图坐标
     for area_type in ['stuck', 'success', 'login', 'special']:
         enable_key = f'enable{area_type}areasearch'
@@ -226,7 +356,23 @@ def load_config(config_path):
                 cfg[bbox_key] = None
         else:
             cfg[f'{area_type}searchareabbox'] = None
-            
+
+    # 诊断时每轮只截取一次所有检测区域的外接区域，各项检测再从中切片
+    frame_bboxes = [cfg['successsearchareabbox'], cfg['stucksearchareabbox']]
+    if cfg['enablespecialcheck']:
+        frame_bboxes.append(cfg['specialsearchareabbox'])
+    if cfg['enableloginscreencheck']:
+        frame_bboxes.append(cfg['loginsearchareabbox'])
+    cfg['diagnosticsearchareabbox'] = union_bbox(frame_bboxes)
+
+    # 预加载所有模板到缓存，避免在诊断循环中重复读取和解码图片。
+    # 不存在或无法读取的模板在此一次性剔除，诊断循环中不再检查模板文件。
+    # 同一模板只保留一次: 并行匹配时每个模板的输出缓冲区只能被一个线程使用
+    cfg['templatestuckimagenames'] = [path for path in dict.fromkeys(cfg['templatestuckimagenames']) if get_template(path)]
+    for key in ['templatesuccessimagename', 'templateloginimagename', 'templateminimizebuttonimagename', 'templatespecialimagename']:
+        if cfg[key] and not get_template(cfg[key]):
+            cfg[key] = ''
+
     return cfg
 
 
@@ -234,6 +380,294 @@ def load_config(config_path):
 # --- 2. 系统与图像识别核心功能模块 ---
 # ==============================================================================
 
+def capture_screen(bbox=None):
+    """
+    【重量级操作】截取屏幕区域，返回 BGRA 排列的 numpy 数组 (高, 宽, 4)。
+    数组直接引用 mss 的原始截图缓冲区，不做通道重排或复制。
+    bbox 为 (左, 上, 右, 下)，为 None 时截取主显示器全屏。
+    """
+    global _SCT
+    if _SCT is None:
+        _SCT = mss.mss()
+    region = bbox if bbox else _SCT.monitors[1]
+    sct_img = _SCT.grab(region)
+    return np.frombuffer(sct_img.raw, dtype=np.uint8).reshape(sct_img.height, sct_img.width, 4)
+
+
+def grab_once(bbox=None):
+    """
+    【重量级操作】截图一次，返回 (BGRA 图像, 灰度图像)，供多个检测函数共享。
+    匹配只使用灰度图，BGRA 图像直接引用截图缓冲区，仅在保存截图时才转换为 BGR。
+    注意: 灰度图写入按尺寸复用的缓冲区，下一次同尺寸截图会覆盖它。
+    """
+    frame = capture_screen(bbox)
+    gray = _GRAY_BUFFERS.get(frame.shape[:2])
+    if gray is None:
+        gray = np.empty(frame.shape[:2], np.uint8)
+        _GRAY_BUFFERS[frame.shape[:2]] = gray
+    cv2.cvtColor(frame, cv2.COLOR_BGRA2GRAY, dst=gray)
+    return frame, gray
+
+
+def union_bbox(bboxes):
+    """返回多个区域的最小外接区域 (左, 上, 右, 下)。任一区域为 None (全屏) 时返回 None。"""
+    if not bboxes or any(bbox is None for bbox in bboxes):
+        return None
+    return (
+        min(bbox[0] for bbox in bboxes),
+        min(bbox[1] for bbox in bboxes),
+        max(bbox[2] for bbox in bboxes),
+        max(bbox[3] for bbox in bboxes),
+    )
+
+
+def crop_to_bbox(image, image_bbox, bbox):
+    """
+    从按 image_bbox 截取的图像中切出 bbox 对应区域的视图 (不复制数据)。
+    返回 (视图, 视图左上角的屏幕坐标)。bbox 为 None 时返回整张图像。
+    """
+    origin_x, origin_y = (image_bbox[0], image_bbox[1]) if image_bbox else (0, 0)
+    if not bbox:
+        return image, (origin_x, origin_y)
+    view = image[bbox[1] - origin_y:bbox[3] - origin_y, bbox[0] - origin_x:bbox[2] - origin_x]
+    return view, (bbox[0], bbox[1])
+
+
+def is_frame_unchanged(frame_small, reference_small):
+    """判断缩小后的画面与参考画面相比是否没有变化。"""
+    if reference_small is None or frame_small.shape != reference_small.shape:
+        return False
+    return cv2.absdiff(frame_small, reference_small).max() <= FRAME_DIFF_MAX
+
+
+def save_screenshot(filename, image):
+    """保存 BGR 图像。使用 imencode + tofile 以兼容包含中文的路径。"""
+    ok, buf = cv2.imencode(os.path.splitext(filename)[1], image)
+    if not ok:
+        raise IOError(f"图像编码失败: {filename}")
+    buf.tofile(filename)
+
+
+def get_template(template_path):
+    """
+    从缓存中获取模板，首次访问时读取并预处理。
+    返回包含 name/image/gray/w/h/scale/gray_small 及频域匹配常量的字典，读取失败时返回 None。
+    """
+    if not template_path:
+        return None
+    cached = _TEMPLATE_CACHE.get(template_path)
+    if cached is not None:
+        return cached
+
+    if not os.path.exists(template_path):
+        logging.warning(f"模板文件不存在，跳过: {template_path}")
+        return None
+
+    # 模板只在此处解码一次；使用 fromfile + imdecode 以兼容包含中文的路径
+    template_image = cv2.imdecode(np.fromfile(template_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if template_image is None:
+        logging.error(f"无法读取模板 '{template_path}'，跳过。")
+        return None
+
+    template_gray = cv2.cvtColor(template_image, cv2.COLOR_BGR2GRAY)
+    h, w = template_image.shape[:2]
+
+    # 选择粗匹配的缩小倍数: 模板太小时缩小后特征会丢失，此时 scale 为 1 表示不做粗匹配
+    scale = next((s for s in COARSE_SCALES if min(w, h) // s >= COARSE_MIN_TEMPLATE_SIDE), 1)
+    gray_small = None
+    if scale > 1:
+        gray_small = template_gray
+        for _ in range(scale.bit_length() - 1):
+            gray_small = cv2.pyrDown(gray_small)
+
+    # 频域匹配所需的模板常量: 零均值模板及其平方和 (TM_CCOEFF_NORMED 分母中的模板项)
+    template_zero_mean = template_gray.astype(np.float32) - float(template_gray.mean())
+
+    cached = {
+        'name': os.path.basename(template_path),  # 用于日志输出，避免每次调用 basename
+        'image': template_image,
+        'gray': template_gray,
+        'w': w,
+        'h': h,
+        'scale': scale,
+        'gray_small': gray_small,
+        'zero_mean': template_zero_mean,
+        'var': float((template_zero_mean ** 2).sum()),
+        'dfts': {},  # 按 DFT 尺寸缓存的模板频谱，首次在该尺寸的截图上匹配时计算
+        'results': {},  # 按结果尺寸复用的 matchTemplate 输出缓冲区
+    }
+    _TEMPLATE_CACHE[template_path] = cached
+    return cached
+
+
+def setup_opencl(enabled):
+    """根据配置启用或关闭 OpenCL 加速的模板匹配。设备不支持 OpenCL 时自动回退到 CPU。"""
+    global _USE_OPENCL
+    _USE_OPENCL = bool(enabled) and cv2.ocl.haveOpenCL()
+    cv2.ocl.setUseOpenCL(_USE_OPENCL)
+    if enabled and not _USE_OPENCL:
+        logging.warning("已配置启用 OpenCL，但当前设备不支持，模板匹配将使用 CPU。")
+    elif _USE_OPENCL:
+        logging.info("已启用 OpenCL 加速模板匹配。")
+
+
+def setup_cuda(enabled):
+    """根据配置启用或关闭 CUDA 加速的模板匹配。OpenCV 未编译 CUDA 模块或没有 NVIDIA 显卡时自动回退。"""
+    global _USE_CUDA
+    try:
+        _USE_CUDA = bool(enabled) and cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        _USE_CUDA = False
+    if enabled and not _USE_CUDA:
+        logging.warning("已配置启用 CUDA，但当前 OpenCV 或设备不支持，模板匹配将不使用 CUDA。")
+    elif _USE_CUDA:
+        logging.info("已启用 CUDA 加速模板匹配。")
+
+
+def match_template(image, template, key='gray', method=cv2.TM_CCOEFF_NORMED):
+    """
+    用缓存模板中 key 对应的图像执行 cv2.matchTemplate，返回 numpy 相似度图。
+    CPU 路径下结果写入模板缓存中按尺寸预分配的缓冲区，下一次同尺寸匹配会覆盖它，调用方应立即使用。
+    启用 OpenCL 时截图和模板均以 UMat 形式交给 GPU 运算，模板的 UMat 首次使用时创建并缓存。
+    启用 CUDA 时模板只上传一次，匹配器按模板缓存 (同一模板同一时刻只被一个线程使用)；
+    截图与结果的 GpuMat 以及下载结果的缓冲区同样按尺寸缓存在 template['results'] 中复用。
+    """
+    if _USE_CUDA:
+        gpu_key = (key, method, 'cuda')
+        cached = template.get(gpu_key)
+        if cached is None:
+            template_gpu = cv2.cuda_GpuMat()
+            template_gpu.upload(template[key])
+            matcher = cv2.cuda.createTemplateMatching(template_gpu.type(), method)
+            cached = (template_gpu, matcher)
+            template[gpu_key] = cached
+        template_gpu, matcher = cached
+        buffers_key = gpu_key + image.shape[:2]
+        buffers = template['results'].get(buffers_key)
+        if buffers is None:
+            templ = template[key]
+            result_shape = (image.shape[0] - templ.shape[0] + 1, image.shape[1] - templ.shape[1] + 1)
+            buffers = (cv2.cuda_GpuMat(), cv2.cuda_GpuMat(), np.empty(result_shape, np.float32))
+            template['results'][buffers_key] = buffers
+        image_gpu, result_gpu, result = buffers
+        image_gpu.upload(np.ascontiguousarray(image))
+        matcher.match(image_gpu, template_gpu, result_gpu)
+        result_gpu.download(result)
+        return result
+    if not _USE_OPENCL:
+        templ = template[key]
+        result_shape = (image.shape[0] - templ.shape[0] + 1, image.shape[1] - templ.shape[1] + 1)
+        result_key = (key, method) + result_shape
+        result = template['results'].get(result_key)
+        if result is None:
+            result = np.empty(result_shape, np.float32)
+            template['results'][result_key] = result
+        return cv2.matchTemplate(image, templ, method, result=result)
+    umat_key = key + '_umat'
+    template_umat = template.get(umat_key)
+    if template_umat is None:
+        template_umat = cv2.UMat(template[key])
+        template[umat_key] = template_umat
+    return cv2.matchTemplate(cv2.UMat(np.ascontiguousarray(image)), template_umat, method).get()
+
+
+def prepare_template_matching(cfg):
+    """
+    按配置中已知尺寸的搜索区域预先执行一次匹配 (使用空白图像)，
+    让各模板针对这些固定尺寸的输出缓冲区、频谱 (以及启用显卡加速时的 UMat / CUDA 匹配器) 在启动时准备好。
+    须在 load_config 剔除无效模板、并且 setup_opencl / setup_cuda 选定匹配后端之后调用。
+    未配置搜索区域 (全屏) 的检测在首次截图时再准备。匹配出错时由各检测函数自行记录日志。
+    """
+    def blank(bbox):
+        shape = (bbox[3] - bbox[1], bbox[2] - bbox[0])
+        return np.zeros(shape + (4,), np.uint8), np.zeros(shape, np.uint8)
+
+    if cfg['successsearchareabbox'] and cfg['templatesuccessimagename']:
+        _, gray = blank(cfg['successsearchareabbox'])
+        count_success_in(gray, cfg['templatesuccessimagename'], cfg['successtemplatethreshold'], cfg['successfastmatch'])
+    searches = [
+        ('stucksearchareabbox', cfg['templatestuckimagenames'], cfg['stucktemplatethreshold']),
+        ('specialsearchareabbox', [cfg['templatespecialimagename']], cfg['specialtemplatethreshold']),
+        ('loginsearchareabbox', [cfg['templateloginimagename'], cfg['templateminimizebuttonimagename']], cfg['logintemplatethreshold']),
+    ]
+    for bbox_key, template_paths, threshold in searches:
+        bbox = cfg[bbox_key]
+        template_paths = [path for path in template_paths if path]
+        if bbox and template_paths:
+            image, gray = blank(bbox)
+            find_stuck_in(image, gray, template_paths, threshold, color=cfg['enablecolormatch'])
+
+
+def get_small_image(main_gray, scale, small_images):
+    """
+    获取按 scale 缩小的截图 (高斯金字塔)，同一张截图的每一层只计算一次。
+    每一层由上一层 pyrDown 得到，缩小 4 倍时直接复用已缩小 2 倍的结果。
+    """
+    if scale == 1:
+        return main_gray
+    main_small = small_images.get(scale)
+    if main_small is None:
+        main_small = cv2.pyrDown(get_small_image(main_gray, scale // 2, small_images))
+        small_images[scale] = main_small
+    return main_small
+
+
+def result_max(res):
+    """
+    返回相似度图的 (最大值, 最大值位置 (x, y))。
+    只需要最大值时，对连续内存做一次 argmax 比 cv2.minMaxLoc (同时求最小值和最大值) 少一次遍历。
+    """
+    index = int(res.argmax())
+    return float(res.flat[index]), (index % res.shape[1], index // res.shape[1])
+
+
+def match_template_coarse_to_fine(main_gray, template, threshold, small_images, main_color=None):
+    """
+    粗到细灰度模板匹配，返回 (最大相似度, 匹配左上角坐标)。
+    先在缩小的灰度截图上定位候选位置，粗匹配得分低于放宽后的阈值则直接返回；
+    否则对每个不低于放宽阈值的粗匹配局部极大值，在其附近的原分辨率区域内重新匹配，取精确相似度最高者。
+    (只复核全局最高点时，模糊的相似干扰物可能抢占粗匹配最高点，导致真正的目标漏检。)
+    small_images 用于在同一次截图的多个模板之间共享缩小后的截图。
+    传入 main_color (BGR 截图) 时，原分辨率的精确匹配改用彩色图，用于依赖颜色区分的模板。
+    """
+    scale = template['scale']
+    main_h, main_w = main_gray.shape[:2]
+    fine_image, fine_key = (main_gray, 'gray') if main_color is None else (main_color, 'image')
+    if scale == 1 or main_w // scale < template['gray_small'].shape[1] or main_h // scale < template['gray_small'].shape[0]:
+        # 无法缩小时在整张截图上匹配；大模板走频域匹配，计算量与模板尺寸基本无关
+        if main_color is None and template['w'] * template['h'] > FFT_MIN_TEMPLATE_AREA:
+            res = match_template_fft(main_gray, template)
+        else:
+            res = match_template(fine_image, template, fine_key)
+        return result_max(res)
+
+    main_small = get_small_image(main_gray, scale, small_images)
+    res = match_template(main_small, template, 'gray_small')
+    coarse_val, coarse_loc = result_max(res)
+    coarse_threshold = threshold - COARSE_THRESHOLD_RELAX
+    if coarse_val < coarse_threshold:
+        return coarse_val, (coarse_loc[0] * scale, coarse_loc[1] * scale)
+
+    # 候选位置: 粗匹配相似度图中不低于放宽阈值的局部极大值 (全局最高点必在其中)。
+    # res 是会被下一次同尺寸匹配覆盖的缓冲区，先提取为列表再逐个复核
+    ys, xs = np.nonzero((res >= cv2.dilate(res, None)) & (res >= coarse_threshold))
+    candidates = list(zip(xs.tolist(), ys.tolist()))
+
+    # 在原分辨率下，只对各候选位置附近的小区域做精确匹配
+    margin = scale + COARSE_ROI_MARGIN
+    best_val, best_loc = -1.0, (coarse_loc[0] * scale, coarse_loc[1] * scale)
+    for cx, cy in candidates:
+        coarse_x, coarse_y = cx * scale, cy * scale
+        x1 = max(coarse_x - margin, 0)
+        y1 = max(coarse_y - margin, 0)
+        x2 = min(coarse_x + template['w'] + margin, main_w)
+        y2 = min(coarse_y + template['h'] + margin, main_h)
+        max_val, max_loc = result_max(match_template(fine_image[y1:y2, x1:x2], template, fine_key))
+        if max_val > best_val:
+            best_val, best_loc = max_val, (max_loc[0] + x1, max_loc[1] + y1)
+    return best_val, best_loc
+
+
 def send_webhook_notification(config, alert_type, message):
     """通过Webhook发送结构化的JSON告警。"""
     # 新增: 守卫子句，检查通知是否已全局启用
@@ -252,6 +686,9 @@ def send_webhook_notification(config, alert_type, message):
         "timestamp": time.time()
     }
 
+    # requests 导入较慢且只有 Webhook 用到 (默认关闭)，推迟到首次发送通知时再导入
+    import requests
+
     try:
         # 设置一个合理的超时时间，例如5秒
         response = requests.post(url, json=payload, timeout=5)
@@ -261,12 +698,19 @@ def send_webhook_notification(config, alert_type, message):
         logging.error(f"发送Webhook通知失败: {e}")
 
 def get_local_ip():
-    """获取本机IPv4地址，提供多种回退机制。"""
+    """
+    获取本机IPv4地址，提供多种回退机制。
+    通过路由查询成功获取的地址会被缓存；回退得到的地址不缓存，以便网络恢复后重新获取。
+    """
+    global _LOCAL_IP
+    if _LOCAL_IP:
+        return _LOCAL_IP
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 80))
         ip = s.getsockname()[0]
         s.close()
+        _LOCAL_IP = ip
         return ip
     except OSError:
         try:
@@ -280,19 +724,114 @@ def get_process_count(process_name):
     if not process_name:
         return 0
     try:
-        command = f'tasklist /FI "IMAGENAME eq {process_name}"'
-        output = os.popen(command).read()
-        return output.count(process_name)
+        return count_processes_by_name(process_name)
     except Exception as e:
         logging.error(f"检查进程数时出错: {e}")
         return -1  # -1 表示检查失败
 
 
-def check_and_handle_login_screen(config):
+def count_processes_by_name(process_name):
+    """
+    通过 CreateToolhelp32Snapshot 对系统进程列表做一次快照，按映像名精确比较计数
+    (Windows 下不区分大小写)。不启动 tasklist 子进程，也不构造逐进程的包装对象。
+    """
+    snapshot = _KERNEL32.CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0)
+    if snapshot == INVALID_HANDLE_VALUE:
+        raise ctypes.WinError(ctypes.get_last_error())
+    try:
+        entry = PROCESSENTRY32W()
+        entry.dwSize = ctypes.sizeof(PROCESSENTRY32W)
+        target = process_name.lower()
+        count = 0
+        has_entry = _KERNEL32.Process32FirstW(snapshot, ctypes.byref(entry))
+        while has_entry:
+            if entry.szExeFile.lower() == target:
+                count += 1
+            has_entry = _KERNEL32.Process32NextW(snapshot, ctypes.byref(entry))
+        return count
+    finally:
+        _KERNEL32.CloseHandle(snapshot)
+
+
+def click_at(x, y):
+    """
+    将鼠标移动到屏幕坐标 (x, y) 并单击左键。
+    直接调用 user32 的 SetCursorPos + mouse_event，不经过 pyautogui 的安全检查和暂停。
+    """
+    user32 = ctypes.windll.user32
+    if not user32.SetCursorPos(int(x), int(y)):
+        raise ctypes.WinError()
+    user32.mouse_event(MOUSEEVENTF_LEFTDOWN, 0, 0, 0, 0)
+    user32.mouse_event(MOUSEEVENTF_LEFTUP, 0, 0, 0, 0)
+
+
+def create_process_watcher(process_name):
+    """
+    创建指定进程启动/退出事件的 WMI 监听器，用于替代主循环中的固定间隔休眠。
+    创建失败时返回 None，调用方将回退为定时轮询。
+    """
+    if not process_name:
+        return None
+    # WQL 字符串字面量中的反斜杠和单引号需要转义，否则进程名会破坏查询语句
+    escaped_name = process_name.replace('\\', '\\\\').replace("'", "\\'")
+    query = (
+        "SELECT * FROM __InstanceOperationEvent WITHIN 2 "
+        "WHERE TargetInstance ISA 'Win32_Process' "
+        f"AND TargetInstance.Name = '{escaped_name}' "
+        "AND (__CLASS = '__InstanceCreationEvent' OR __CLASS = '__InstanceDeletionEvent')"
+    )
+    try:
+        return wmi.WMI().watch_for(raw_wql=query)
+    except Exception as e:
+        logging.warning(f"无法创建进程事件监听，将回退为定时轮询: {e}")
+        return None
+
+
+def wait_for_process_event(watcher, timeout_seconds, stop_event=None):
+    """
+    等待进程启动或退出事件，最多等待 timeout_seconds 秒。
+    返回 True 表示收到事件，False 表示超时或收到退出请求 (stop_event 被设置)。
+    没有监听器时等同于可被 stop_event 打断的休眠。
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    if watcher is None:
+        wait_for_stop(stop_event, timeout_seconds)
+        return False
+    # 分段等待事件，每段结束时检查一次退出请求
+    deadline = time.monotonic() + timeout_seconds
+    while not stop_event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        try:
+            watcher(timeout_ms=int(min(remaining, STOP_CHECK_INTERVAL) * 1000))
+            return True
+        except wmi.x_wmi_timed_out:
+            continue
+    return False
+
+
+def wait_for_stop(stop_event, timeout_seconds):
+    """
+    最多等待 timeout_seconds 秒，期间收到退出请求时立即返回 True，超时返回 False。
+    按 STOP_CHECK_INTERVAL 分段等待，保证 Windows 上信号处理函数能及时得到执行。
+    """
+    deadline = time.monotonic() + timeout_seconds
+    while not stop_event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        stop_event.wait(min(remaining, STOP_CHECK_INTERVAL))
+    return True
+
+
+def check_and_handle_login_screen(config, frame, stop_event=None):
     """
     独立的登录界面检测和处理器 (两阶段搜索)。
     阶段一: 查找登录界面标志。
     阶段二: 如果找到，则查找最小化按钮并点击。
+    frame 为诊断循环已截取的 (BGRA 图像, 灰度图像, 截图区域)，两个阶段都直接从中切片而不再截图。
     """
     
     if not config.get('enableloginscreencheck', False):
@@ -305,8 +844,11 @@ def check_and_handle_login_screen(config):
     
     if not login_template_path:
         return False
-        
-    is_login_screen_found, _ = find_stuck_template([login_template_path], login_threshold, search_bbox, config=config)
+
+    frame_image, frame_gray, frame_bbox = frame
+    login_image, login_offset = crop_to_bbox(frame_image, frame_bbox, search_bbox)
+    login_gray, _ = crop_to_bbox(frame_gray, frame_bbox, search_bbox)
+    is_login_screen_found, _ = find_stuck_in(login_image, login_gray, [login_template_path], login_threshold, login_offset, config=config, color=config['enablecolormatch'])
 
     if not is_login_screen_found:
         return False # 未找到登录界面，流程结束
@@ -321,17 +863,17 @@ def check_and_handle_login_screen(config):
         logging.warning("已配置检查登录界面，但未配置最小化按钮模板。")
         return False
 
-    is_minimize_btn_found, btn_location = find_stuck_template([minimize_template_path], minimize_threshold, search_bbox, config=config)
+    is_minimize_btn_found, btn_location = find_stuck_in(login_image, login_gray, [minimize_template_path], minimize_threshold, login_offset, config=config, color=config['enablecolormatch'])
 
     if is_minimize_btn_found:
         logging.debug("阶段二成功: 找到最小化按钮，准备点击。")
         try:
             # 直接点击找到的按钮中心，无偏移
-            pyautogui.click(btn_location[0], btn_location[1])
+            click_at(btn_location[0], btn_location[1])
             
             delay = config.get('loginclickdelay', 5)
             logging.info(f"点击完成，等待 {delay} 秒以响应...")
-            time.sleep(delay)
+            wait_for_stop(stop_event or threading.Event(), delay)
             return True # 表示已成功处理
         except Exception as e:
             logging.error(f"执行最小化按钮点击时失败: {e}")
@@ -341,83 +883,183 @@ def check_and_handle_login_screen(config):
     return False
 
 
-def find_stuck_template(template_paths, threshold, bbox=None, config=None):
+def find_stuck_in(main_image, main_gray, template_paths, threshold, offset=(0, 0), config=None, color=False):
     """
-    【重量级操作】依次查找多个“卡住”模板中的任意一个。
-    只要有一个匹配成功，就立即返回。
+    在已截取的图像中并行查找多个“卡住”模板中的任意一个，不再重复截图。
+    默认在灰度图上匹配 (计算量为彩色图的 1/3)，BGRA 彩色图仅用于保存截图；
+    color 为 True 时，精确匹配改用彩色图 (对应配置项 EnableColorMatch)。
+    offset 为图像左上角的屏幕坐标，用于把匹配位置换算为屏幕坐标。
     """
     try:
-        screenshot = ImageGrab.grab(bbox=bbox)
-        main_image = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-
+        templates = []
         for template_path in template_paths:
-            if not os.path.exists(template_path):
-                logging.warning(f"模板文件不存在，跳过: {template_path}")
-                continue
-            
-            template_image = cv2.imread(template_path)
-            if template_image is None:
-                logging.error(f"无法读取模板 '{template_path}'，跳过。")
-                continue
-            
-            h, w = template_image.shape[:2]
-            res = cv2.matchTemplate(main_image, template_image, cv2.TM_CCOEFF_NORMED)
-            _, max_val, _, max_loc = cv2.minMaxLoc(res)
-
-            logging.debug(f"查找模板 '{os.path.basename(template_path)}': 最大相似度 {max_val:.4f} (阈值: {threshold})")
-
-            if max_val >= threshold:
-                logging.info(f"成功匹配到'卡住'模板: '{os.path.basename(template_path)}' (相似度: {max_val:.4f})")
-                
-                # 当找到模板时，根据配置保存截图
-                if config and config.get('savestuckscreenshot'):
-                    save_path = config.get('screenshotsavepath', 'screenshots')
-                    try:
-                        os.makedirs(save_path, exist_ok=True)
-                        timestamp = time.strftime('%Y%m%d_%H%M%S')
-                        filename = os.path.join(save_path, f"stuck_snapshot_{timestamp}.png")
-                        screenshot.save(filename)
-                        logging.info(f"已将'卡住'状态的截图保存至: {filename}")
-                    except Exception as e:
-                        logging.error(f"保存'卡住'截图时失败: {e}")
-
-                center_x = max_loc[0] + w // 2
-                center_y = max_loc[1] + h // 2
-                if bbox:
-                    center_x += bbox[0]
-                    center_y += bbox[1]
-                return True, (center_x, center_y) # 立即返回
-
-        return False, None # 所有模板都未匹配
+            template = get_template(template_path)
+            if template is not None:
+                templates.append((template_path, template))
+
+        # 按缩小倍数缓存的截图，在提交任务前生成好，供各线程只读共享
+        small_images = {}
+        for _, template in templates:
+            if template['scale'] > 1:
+                get_small_image(main_gray, template['scale'], small_images)
+
+        main_color = cv2.cvtColor(main_image, cv2.COLOR_BGRA2BGR) if color else None
+
+        futures = {
+            _POOL.submit(match_template_coarse_to_fine, main_gray, template, threshold, small_images, main_color): (template_path, template)
+            for template_path, template in templates
+        }
+        try:
+            for future in as_completed(futures):
+                template_path, template = futures[future]
+                max_val, max_loc = future.result()
+                logging.debug("查找模板 '%s': 最大相似度 %.4f (阈值: %s)", template['name'], max_val, threshold)
+                if max_val >= threshold:
+                    break
+            else:
+                return False, None # 所有模板都未匹配
+        finally:
+            # 已找到匹配 (或出错) 时取消尚未开始的任务，并等待正在运行的匹配结束 (均为毫秒级)。
+            # 否则它们会在本函数返回后继续读取截图缓冲区、写入模板的结果缓冲区，
+            # 与下一次截图和下一次 find_stuck_in 重叠，破坏“同一缓冲区同一时刻只被一个线程使用”的前提
+            for pending in futures:
+                pending.cancel()
+            wait(futures)
+
+        w, h = template['w'], template['h']
+        logging.info("成功匹配到'卡住'模板: '%s' (相似度: %.4f)", template['name'], max_val)
+
+        # 当找到模板时，根据配置保存截图
+        if config and config.get('savestuckscreenshot'):
+            save_path = config.get('screenshotsavepath', 'screenshots')
+            try:
+                os.makedirs(save_path, exist_ok=True)
+                timestamp = time.strftime('%Y%m%d_%H%M%S')
+                filename = os.path.join(save_path, f"stuck_snapshot_{timestamp}.png")
+                save_screenshot(filename, cv2.cvtColor(main_image, cv2.COLOR_BGRA2BGR))
+                logging.info(f"已将'卡住'状态的截图保存至: {filename}")
+            except Exception as e:
+                logging.error(f"保存'卡住'截图时失败: {e}")
+
+        center_x = max_loc[0] + w // 2 + offset[0]
+        center_y = max_loc[1] + h // 2 + offset[1]
+        return True, (center_x, center_y)
     except Exception as e:
         logging.error(f"查找'卡住'模板时出错: {e}")
         return False, None
 
 
-def count_success_templates(template_path, threshold, bbox=None):
+def match_template_fft(main_gray, template, main_cache=None):
+    """
+    基于 DFT 的 TM_CCOEFF_NORMED 模板匹配，返回与 cv2.matchTemplate 相同尺寸的相似度图。
+    分子为截图与零均值模板的互相关 (频域相乘)，分母由积分图计算每个窗口的方差。
+    main_cache 用于在同一张截图的多个模板之间共享截图的频谱和积分图。
+    """
+    if main_cache is None:
+        main_cache = {}
+    main_h, main_w = main_gray.shape[:2]
+    h, w = template['h'], template['w']
+    n = w * h
+    dft_h, dft_w = cv2.getOptimalDFTSize(main_h), cv2.getOptimalDFTSize(main_w)
+
+    main_dft = main_cache.get('dft')
+    if main_dft is None:
+        main_padded = np.zeros((dft_h, dft_w), np.float32)
+        main_padded[:main_h, :main_w] = main_gray
+        main_dft = cv2.dft(main_padded, flags=cv2.DFT_COMPLEX_OUTPUT)
+        main_cache['dft'] = main_dft
+
+    # 零均值模板的频谱只与 DFT 尺寸有关，按尺寸缓存在模板数据中；互相关结果即为 TM_CCOEFF 的分子
+    template_dft = template['dfts'].get((dft_h, dft_w))
+    if template_dft is None:
+        template_padded = np.zeros((dft_h, dft_w), np.float32)
+        template_padded[:h, :w] = template['zero_mean']
+        template_dft = cv2.dft(template_padded, flags=cv2.DFT_COMPLEX_OUTPUT)
+        template['dfts'][(dft_h, dft_w)] = template_dft
+    template_var = template['var']
+
+    spectrum = cv2.mulSpectrums(main_dft, template_dft, 0, conjB=True)
+    corr = cv2.idft(spectrum, flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+    numerator = corr[:main_h - h + 1, :main_w - w + 1]
+
+    # 用积分图计算每个窗口内的像素和与平方和
+    integrals = main_cache.get('integral')
+    if integrals is None:
+        integrals = cv2.integral2(main_gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        main_cache['integral'] = integrals
+    sum_img, sqsum_img = integrals
+    window_sum = sum_img[h:, w:] - sum_img[:-h, w:] - sum_img[h:, :-w] + sum_img[:-h, :-w]
+    window_sqsum = sqsum_img[h:, w:] - sqsum_img[:-h, w:] - sqsum_img[h:, :-w] + sqsum_img[:-h, :-w]
+    window_var = np.maximum(window_sqsum - window_sum ** 2 / n, 0)
+
+    denominator = np.sqrt(window_var * template_var)
+    res = np.zeros_like(numerator)
+    valid = denominator > 1e-6
+    res[valid] = numerator[valid] / denominator[valid]
+    return np.clip(res, -1, 1, out=res)
+
+
+def count_local_maxima(res, threshold, w, h):
+    """
+    统计相似度图中不低于阈值的局部极大值个数，每个极大值对应一个目标。
+    一个点只有在以它为中心、约为模板大小 (半径 w/2 × h/2) 的窗口内取得最大值时才被保留，
+    从而把同一目标周围一片超过阈值的点合并为一个。
+    """
+    if res.size == 0 or res.max() < threshold:
+        return 0  # 没有任何点达到阈值，无需做膨胀和去重
+    kernel = np.ones((2 * (h // 2) + 1, 2 * (w // 2) + 1), np.uint8)
+    local_max = cv2.dilate(res, kernel)
+    ys, xs = np.nonzero((res >= local_max) & (res >= threshold))
+    # 相似度相同的相邻点 (平台区域) 都会被保留，需要再去重一次
+    return dedupe_points(xs, ys, res[ys, xs], w // 2, h // 2)
+
+
+def dedupe_points(xs, ys, scores, radius_x, radius_y):
+    """
+    基于网格哈希的重复点去除，返回保留的点数。
+    按相似度从高到低处理，若某点与已保留点的横向距离不超过 radius_x 且纵向距离不超过 radius_y
+    (与 count_local_maxima 的膨胀窗口一致) 则丢弃，这样上下或左右紧挨着的非正方形目标不会被误合并。
+    网格边长取 (radius_x, radius_y)，只需检查所在格及相邻 8 格，复杂度为 O(n)。
+    """
+    cell_x, cell_y = max(radius_x, 1), max(radius_y, 1)
+    grid = {}
+    kept = 0
+    for i in np.argsort(-scores, kind='stable'):
+        x, y = int(xs[i]), int(ys[i])
+        cx, cy = x // cell_x, y // cell_y
+        is_duplicate = any(
+            abs(x - px) <= radius_x and abs(y - py) <= radius_y
+            for gx in (cx - 1, cx, cx + 1)
+            for gy in (cy - 1, cy, cy + 1)
+            for px, py in grid.get((gx, gy), ())
+        )
+        if not is_duplicate:
+            grid.setdefault((cx, cy), []).append((x, y))
+            kept += 1
+    return kept
+
+
+def count_success_in(main_image_gray, template_path, threshold, fast_match=False):
     """
-    【重量级操作】专门用于计数多个“成功”模板 (如'X'按钮)。
+    在已截取的灰度图中计数多个“成功”模板 (如'X'按钮)，不再重复截图。
     使用灰度图和去重逻辑，返回找到的数量。
+    fast_match 为 True 时，小模板改用 TM_SQDIFF_NORMED (无需减均值，计算量更小)，
+    并以 1 - 归一化平方差 作为相似度与阈值比较。
     """
     try:
-        if not os.path.exists(template_path): return 0
-        
-        screenshot = ImageGrab.grab(bbox=bbox)
-        main_image_gray = cv2.cvtColor(np.array(screenshot), cv2.COLOR_BGR2GRAY)
-        template_image_gray = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
-        
-        if template_image_gray is None: logging.error(f"无法读取模板 '{template_path}'"); return 0
-        
-        w, h = template_image_gray.shape[::-1]
-        res = cv2.matchTemplate(main_image_gray, template_image_gray, cv2.TM_CCOEFF_NORMED)
+        template = get_template(template_path)
+        if template is None: return 0
         
-        loc = np.where(res >= threshold)
-        rects = [[int(pt[0]), int(pt[1]), int(w), int(h)] for pt in zip(*loc[::-1])]
-        
-        # 过滤重叠的矩形框，groupThreshold=0表示单个框也能被保留
-        rects_grouped, _ = cv2.groupRectangles(rects, groupThreshold=0, eps=0.5)
+        w, h = template['w'], template['h']
+        if w * h > FFT_MIN_TEMPLATE_AREA:
+            res = match_template_fft(main_image_gray, template)
+        elif fast_match:
+            res = 1 - match_template(main_image_gray, template, method=cv2.TM_SQDIFF_NORMED)
+        else:
+            res = match_template(main_image_gray, template)
         
-        return len(rects_grouped)
+        # 非极大值抑制: 同一目标周围超过阈值的多个点只计一次
+        return count_local_maxima(res, threshold, w, h)
     except Exception as e:
         logging.error(f"计数'成功'模板时出错: {e}"); return 0
 
@@ -426,150 +1068,266 @@ def count_success_templates(template_path, threshold, bbox=None):
 # ==============================================================================
 
 
-def handle_alert_state(config):
+def handle_alert_state(config, stop_event=None):
     """
     【重量级诊断与纠正】
     此函数全权负责将系统从任何异常状态恢复到最终的健康状态。
-    只有在成功恢复或超时后，它才会返回。
+    只有在成功恢复、超时或收到退出请求 (stop_event 被设置) 后，它才会返回。
     """
-    # local_ip = get_local_ip()
-    # alert_filepath = os.path.join(config['alertsharepath'], f"{local_ip}_VISUAL_HISTORY.log")
-    
+    if stop_event is None:
+        stop_event = threading.Event()
+    alert_logger = logging.getLogger('alert')
+
     logging.info("--- 已进入重量级诊断与纠正流程 ---")
     start_time = time.time()
     timeout_seconds = config.get('timeoutseconds', 300)
 
-    # 记录进入诊断状态的日志
-    # timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-    # alert_message = f"[{timestamp}] - IP: {local_ip} - 系统状态异常，开始自动纠正流程。"
-    # try:
-    #     with open(alert_filepath, 'a', encoding='utf-8') as f:
-    #         f.write(alert_message + "\n")
-    # 用新的调用替换:
+    # 记录进入诊断状态的日志 (共享文件夹告警日志 + Webhook)
+    alert_logger.info("系统状态异常，开始自动纠正流程。")
     send_webhook_notification(config, "DIAGNOSIS_START", "系统状态异常，开始自动纠正流程。")
 
-    # except Exception as e:
-    #     logging.error(f"写入初始诊断日志时失败: {e}")
-
-    while time.time() - start_time < timeout_seconds:
-        # 1. 检查是否已达到最终健康状态 (包含新的并行检查)
-        proc_count = get_process_count(config['processname'])
-        success_icon_count = count_success_templates(config['templatesuccessimagename'], config['successtemplatethreshold'], config.get('successsearchareabbox'))
-        
-        # 新增: 执行特殊成功状态检查
-        is_special_success = False
-        if config.get('enablespecialcheck'):
-            is_special_success, _ = find_stuck_template(
-                [config['templatespecialimagename']],
-                config['specialtemplatethreshold'],
-                config.get('specialsearchareabbox')
-            )
-
-        logging.debug(f"诊断中 - 进程数: {proc_count}/{config['requiredprocesscount']}, 成功标志: {success_icon_count}/{config['requiredsuccesscount']}, 特殊成功标志: {is_special_success}")
-        
-        # 修改: 组合两种成功条件
-        is_normal_success = (proc_count == config['requiredprocesscount'] and success_icon_count >= config['requiredsuccesscount'])
-        is_special_case_success = (proc_count == config['requiredprocesscount'] and is_special_success)
+    # 每轮只截取一次所有检测区域的外接区域 (在 load_config 中预先计算)
+    frame_bbox = config.get('diagnosticsearchareabbox')
+
+    # 诊断循环中反复用到的配置项，在进入循环前一次性取出
+    process_name = config['processname']
+    required_process_count = config['requiredprocesscount']
+    required_success_count = config['requiredsuccesscount']
+    success_bbox = config.get('successsearchareabbox')
+    special_bbox = config.get('specialsearchareabbox')
+    stuck_bbox = config.get('stucksearchareabbox')
+    enable_special_check = config.get('enablespecialcheck')
+    enable_click = config.get('enableclick', False)
+    click_offset_x = config.get('clickoffsetx', 0)
+    click_offset_y = config.get('clickoffsety', 0)
+    click_retry_delay = config['clickretrydelay']
+    color_match = config['enablecolormatch']
+
+    # 画面未变化时复用上一次的识别结果，跳过全部模板匹配
+    reference_small = None  # 识别结果所对应画面的缩小图
+    frame_results = {}      # 该画面的识别结果: 'success' / 'special' / 'stuck'
+
+    while not stop_event.is_set() and time.time() - start_time < timeout_seconds:
+        # 1. 先做廉价的进程数检查: 进程数未达标时无论屏幕内容如何都不算恢复
+        proc_count = get_process_count(process_name)
+        is_proc_count_ok = (proc_count == required_process_count)
+
+        # 截图一次，成功、特殊成功、登录界面、卡住各项检测共享同一张截图
+        try:
+            frame_image, frame_gray = grab_once(frame_bbox)
+        except Exception as e:
+            logging.error(f"诊断截图失败: {e}，等待5秒后重试...")
+            wait_for_stop(stop_event, 5)
+            continue
 
-        if is_normal_success or is_special_case_success:
-            logging.info("成功！诊断中发现系统已完全恢复健康 (常规或特殊条件满足)，退出诊断流程。")
-            return
+        frame_small = cv2.resize(frame_gray, None, fx=1 / FRAME_DIFF_SCALE, fy=1 / FRAME_DIFF_SCALE, interpolation=cv2.INTER_AREA)
+        if is_frame_unchanged(frame_small, reference_small):
+            logging.debug("画面与上次识别时相比没有变化，复用上次的识别结果。")
+        else:
+            reference_small = frame_small
+            frame_results = {}
+
+        # 只有进程数达标时才需要检查屏幕上的成功标志 (包含新的并行检查)
+        if is_proc_count_ok:
+            if 'success' not in frame_results:
+                success_gray, _ = crop_to_bbox(frame_gray, frame_bbox, success_bbox)
+                frame_results['success'] = count_success_in(success_gray, config['templatesuccessimagename'], config['successtemplatethreshold'], config['successfastmatch'])
+            success_icon_count = frame_results['success']
+            
+            # 新增: 执行特殊成功状态检查
+            is_special_success = False
+            if enable_special_check and 'special' in frame_results:
+                is_special_success = frame_results['special']
+            elif enable_special_check:
+                special_image, special_offset = crop_to_bbox(frame_image, frame_bbox, special_bbox)
+                special_gray, _ = crop_to_bbox(frame_gray, frame_bbox, special_bbox)
+                is_special_success, _ = find_stuck_in(
+                    special_image,
+                    special_gray,
+                    [config['templatespecialimagename']],
+                    config['specialtemplatethreshold'],
+                    special_offset,
+                    color=color_match
+                )
+                frame_results['special'] = is_special_success
+
+            logging.debug("诊断中 - 进程数: %s/%s, 成功标志: %s/%s, 特殊成功标志: %s",
+                          proc_count, required_process_count, success_icon_count, required_success_count, is_special_success)
+            
+            # 修改: 组合两种成功条件 (进程数已达标)
+            if success_icon_count >= required_success_count or is_special_success:
+                logging.info("成功！诊断中发现系统已完全恢复健康 (常规或特殊条件满足)，退出诊断流程。")
+                return
+        else:
+            logging.debug("诊断中 - 进程数: %s/%s，未达标，跳过成功标志检查。", proc_count, required_process_count)
 
         # 2. 优先处理特定的登录界面场景 (作为附加动作，不中断流程)
-        action_taken = check_and_handle_login_screen(config)
+        action_taken = check_and_handle_login_screen(config, (frame_image, frame_gray, frame_bbox), stop_event)
         if action_taken:
             logging.debug("已处理登录界面，将重新评估系统状态。")
             continue  # 跳过本轮后续检查，直接开始新一轮循环
 
         # 3. 如果未恢复，则继续寻找通用的“卡住”模板并尝试点击
-        is_stuck, stuck_location = find_stuck_template(
-            config['templatestuckimagenames'], 
-            config['stucktemplatethreshold'], 
-            config.get('stucksearchareabbox'),
-            config=config
-        )
+        if 'stuck' not in frame_results:
+            stuck_image, stuck_offset = crop_to_bbox(frame_image, frame_bbox, stuck_bbox)
+            stuck_gray, _ = crop_to_bbox(frame_gray, frame_bbox, stuck_bbox)
+            frame_results['stuck'] = find_stuck_in(
+                stuck_image,
+                stuck_gray,
+                config['templatestuckimagenames'], 
+                config['stucktemplatethreshold'], 
+                stuck_offset,
+                config=config,
+                color=color_match
+            )
+        is_stuck, stuck_location = frame_results['stuck']
         if is_stuck:
             logging.warning("诊断中发现通用'卡住'标志，准备点击。")
-            if config.get('enableclick', False) and stuck_location:
+            if enable_click and stuck_location:
                 try:
-                    click_x = stuck_location[0] + config.get('clickoffsetx', 0)
-                    click_y = stuck_location[1] + config.get('clickoffsety', 0)
-                    logging.info(f"在坐标 ({click_x}, {click_y}) 执行点击。")
-                    pyautogui.click(click_x, click_y)
+                    click_x = stuck_location[0] + click_offset_x
+                    click_y = stuck_location[1] + click_offset_y
+                    logging.info("在坐标 (%s, %s) 执行点击。", click_x, click_y)
+                    click_at(click_x, click_y)
                 except Exception as e:
                     logging.error(f"执行点击时失败: {e}")
             
-            logging.info(f"等待 {config['clickretrydelay']} 秒后再次检查...")
-            time.sleep(config['clickretrydelay'])
+            logging.info("等待 %s 秒后再次检查...", click_retry_delay)
+            wait_for_stop(stop_event, click_retry_delay)
         else:
             logging.debug("未找到已知'卡住'或'登录'标志，等待5秒观察变化...")
-            time.sleep(5)
+            wait_for_stop(stop_event, 5)
+
+    if stop_event.is_set():
+        logging.info("收到退出请求，中止诊断与纠正流程。")
+        return
     
     # 4. 如果循环是因为超时而结束
     logging.error(f"诊断超时（{timeout_seconds}秒），未能解决问题。")
-    # final_fail_message = f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] - IP: {local_ip} - 自动纠正超时，问题仍未解决。"
-    # try:
-    #     with open(alert_filepath, 'a', encoding='utf-8') as f:
-    #         f.write(final_fail_message + "\n")
-    # 用新的调用替换:
+    alert_logger.info("自动纠正超时，问题仍未解决。")
     send_webhook_notification(config, "DIAGNOSIS_TIMEOUT", f"诊断超时（{timeout_seconds}秒），未能解决问题。")
 
-    # except Exception as e:
-    #     logging.error(f"写入超时日志时失败: {e}")
-
 
 # ==============================================================================
 # --- 4. 主程序入口与循环 ---
 # ==============================================================================
 
-def main_loop():
+def initialize():
     """
-    主循环，程序的总指挥。
-    实现了状态变更日志记录，仅在状态切换时记录日志。
+    程序启动时的公共初始化: 日志、配置文件、DPI 感知、OpenCV 加速选项和告警日志。
+    成功时返回配置字典，失败时返回 None。
     """
     setup_logging()
     
     config_path = find_and_prepare_config_path()
     if not config_path:
         logging.error("启动失败: 无法找到任何可用的配置文件。")
-        return
+        return None
 
     try:
         config = load_config(config_path)
     except Exception as e:
         logging.error(f"启动失败: 无法加载或解析配置 '{config_path}' - {e}")
+        return None
+
+    # 声明 DPI 感知，使点击坐标与截图坐标同为物理像素 (此前由导入 pyautogui 时完成)
+    ctypes.windll.user32.SetProcessDPIAware()
+    # 显式启用 OpenCV 的 SIMD 优化。同时并行匹配的模板数最多为“卡住”模板的个数 (其余检测只有一个模板)，
+    # 按这个实际并发数分摊 OpenCV 内部线程数: 既不让每个工作线程的 matchTemplate 都占满全部核心，
+    # 也不让成功计数等单模板匹配和整帧的颜色转换、膨胀运算失去 OpenCV 自身的多线程
+    cv2.setUseOptimized(True)
+    match_concurrency = min(MATCH_WORKERS, max(1, len(config['templatestuckimagenames'])))
+    cv2.setNumThreads(max(1, (os.cpu_count() or 1) // match_concurrency))
+    setup_opencl(config['enableopencl'])
+    setup_cuda(config['enablecuda'])
+    prepare_template_matching(config)
+    setup_alert_logger(config)
+    return config
+
+
+def check_once(config, last_status_is_normal=None, stop_event=None):
+    """
+    执行一轮检查: 轻量级检查进程数，异常时进入重量级诊断与纠正流程。
+    last_status_is_normal 为上一轮的状态，用于只在状态切换时记录日志。
+    stop_event 被设置时，诊断前的等待和诊断流程本身都会立即结束。
+    返回本轮检查时状态是否正常。
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    # 1. 轻量级检查：只检查进程数
+    proc_count = get_process_count(config['processname'])
+    current_status_is_normal = (proc_count == config['requiredprocesscount'])
+
+    # 2. 实现状态变更日志记录
+    if current_status_is_normal:
+        if last_status_is_normal is False:
+            logging.info("状态已恢复正常 (进程数: %s)。", proc_count)
+        # 如果状态一直是正常的 (last_status_is_normal is True or None)，则不记录任何日志
+    else:  # 状态异常
+        if last_status_is_normal is not False: # 首次发现异常或从正常转为异常
+            logging.warning("状态异常 (进程数: %s)，启动完整的诊断和纠正流程...", proc_count)
+        else:  # 持续异常，仅在DEBUG模式下提示
+            logging.debug("状态持续异常 (进程数: %s)，仍在诊断中...", proc_count)
+        # 如果状态异常，等待30秒后再诊断 (期间收到退出请求则直接返回)
+        if not wait_for_stop(stop_event, 30):
+            handle_alert_state(config, stop_event)
+
+    return current_status_is_normal
+
+
+def run_once():
+    """
+    单次运行模式 (命令行参数 --once): 只执行一轮检查后退出，供 Windows 任务计划程序等外部调度器定时调用。
+    返回进程退出码: 0 = 状态正常, 1 = 状态异常 (已执行诊断与纠正), 2 = 启动失败, 3 = 检查过程中发生运行时错误。
+    """
+    config = initialize()
+    if config is None:
+        return 2
+    try:
+        return 0 if check_once(config) else 1
+    except Exception as e:
+        logging.error(f"单次检查中发生严重错误: {e}")
+        return 3
+
+
+def main_loop():
+    """
+    主循环，程序的总指挥。
+    实现了状态变更日志记录，仅在状态切换时记录日志。
+    """
+    config = initialize()
+    if config is None:
         return
     
     logging.info("监控程序已启动，进入主循环...")
+
+    loop_interval = config['loopinterval']
+
+    # 进程启动/退出时立即唤醒主循环，无事件时最多等待 loopinterval 秒
+    process_watcher = create_process_watcher(config['processname'])
     
+    # 收到 SIGTERM (或 Windows 下的 SIGBREAK) 时设置退出标志，主循环的等待会被立即打断
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        logging.info("收到退出信号 (%s)，正在退出...", signum)
+        stop_event.set()
+
+    for stop_signal in (signal.SIGTERM, getattr(signal, 'SIGBREAK', None)):
+        if stop_signal is not None:
+            signal.signal(stop_signal, request_stop)
+
     # 用于状态变更检测的变量
     last_status_is_normal = None 
 
-    while True:
+    while not stop_event.is_set():
         try:
-            # 1. 轻量级检查：只检查进程数
-            proc_count = get_process_count(config['processname'])
-            current_status_is_normal = (proc_count == config['requiredprocesscount'])
-
-            # 2. 实现状态变更日志记录
-            if current_status_is_normal:
-                if last_status_is_normal is False:
-                    logging.info(f"状态已恢复正常 (进程数: {proc_count})。")
-                # 如果状态一直是正常的 (last_status_is_normal is True or None)，则不记录任何日志
-            else:  # 状态异常
-                if last_status_is_normal is not False: # 首次发现异常或从正常转为异常
-                    logging.warning(f"状态异常 (进程数: {proc_count})，启动完整的诊断和纠正流程...")
-                else:  # 持续异常，仅在DEBUG模式下提示
-                    logging.debug(f"状态持续异常 (进程数: {proc_count})，仍在诊断中...")
-                time.sleep(30)  # 如果状态异常，休眠60秒后重试
-                handle_alert_state(config)
-            
-            # 更新状态
-            last_status_is_normal = current_status_is_normal
+            last_status_is_normal = check_once(config, last_status_is_normal, stop_event)
 
-            # 3. 主循环休眠
-            logging.debug(f"--- 本轮结束，休眠 {config['loopinterval']} 秒 ---") # 休眠日志也降为DEBUG
-            time.sleep(config['loopinterval'])
+            # 3. 主循环休眠 (收到进程启动/退出事件时提前唤醒)
+            logging.debug("--- 本轮结束，休眠 %s 秒 ---", loop_interval) # 休眠日志也降为DEBUG
+            if wait_for_process_event(process_watcher, loop_interval, stop_event):
+                logging.debug("收到进程启动/退出事件，立即重新检查。")
 
         except KeyboardInterrupt:
             logging.info("脚本被用户手动中断 (Ctrl+C)，正在退出...")
@@ -577,8 +1335,12 @@ def main_loop():
         except Exception as e:
             # 捕获主循环中的未知错误，防止整个程序因意外崩溃
             logging.error(f"主循环中发生严重错误: {e}")
-            logging.info(f"将休眠 {config.get('loopinterval', 60)} 秒后重试...")
-            time.sleep(config.get('loopinterval', 60))
+            logging.info(f"将休眠 {loop_interval} 秒后重试...")
+            wait_for_stop(stop_event, loop_interval)
+
+    logging.info("监控程序已退出。")
 
 if __name__ == '__main__':
-    main_loop()
\ No newline at end of file
+    if '--once' in sys.argv[1:]:
+        sys.exit(run_once())
+    main_loop()
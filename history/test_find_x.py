@@ -1,7 +1,8 @@
 import cv2
 import numpy as np
-from PIL import ImageGrab
+import mss
 import os
+import functools
 
 # ==========================================================
 # --- 1. 配置区 ---
@@ -13,6 +14,10 @@ TEMPLATE_FILENAME = "template_close_button.png"
 # 【请修改】匹配的置信度阈值
 CONFIDENCE_THRESHOLD = 0.8
 
+# 【可选】测试模式: True = 统计所有匹配目标的数量 (对应 Monitor 的“成功”计数)；
+# False = 只判断目标是否存在 (使用 TM_SQDIFF_NORMED 取最佳位置，计算更快，以 1 - 平方差 作为相似度)
+COUNT_ONLY = True
+
 # --- 新增：区域截图配置 ---
 # 【请修改】是否只在特定区域进行测试 (True = 是, False = 否/全屏)
 ENABLE_AREA_SEARCH = True
@@ -21,13 +26,259 @@ ENABLE_AREA_SEARCH = True
 # 这个坐标应该和你 config.ini 里的 SuccessSearchAreaBbox 保持一致
 SEARCH_AREA_BBOX = (700, 0, 960, 400)
 
+# --- 新增：金字塔粗匹配配置 ---
+# 粗匹配时最多缩小的层数 (每层 pyrDown 一次，宽高各减半)，0 表示始终在原分辨率上匹配
+PYRAMID_MAX_LEVELS = 2
+# 缩小后模板的最短边不得小于此值，模板太小时自动减少层数或不做粗匹配
+PYRAMID_MIN_TEMPLATE_SIDE = 8
+# 粗匹配阶段相对正式阈值放宽的幅度，粗匹配得分达到 (阈值 - 此值) 的位置才会在原分辨率下复核
+PYRAMID_THRESHOLD_RELAX = 0.1
+
+# --- 新增：显卡加速配置 ---
+# 【可选】是否使用 CUDA (NVIDIA 显卡) 执行原分辨率的模板匹配 (对应 config.ini 的 EnableCUDA)。
+# 需要带 CUDA 模块编译的 OpenCV，不满足时自动回退到 CPU。
+USE_CUDA = False
+
+# 不做粗匹配且模板面积超过此值时，改用频域 (DFT) 匹配 (与 Monitor.py 的 FFT_MIN_TEMPLATE_AREA 一致)
+FFT_MIN_TEMPLATE_AREA = 18 * 18
+
 # ==========================================================
 # --- 2. 测试逻辑 ---
 # ==========================================================
 
-def run_test():
+# mss 截图实例，首次截图时创建，之后复用 (与 Monitor.py 的截图方式一致)
+_SCT = None
+
+# 按尺寸复用的灰度图和 matchTemplate 输出缓冲区，重复调用 run_test 时不再重新分配
+_GRAY_BUFFERS = {}
+_RESULT_BUFFERS = {}
+
+# 按匹配方法缓存的 CUDA 模板匹配器，首次使用时创建；None 表示尚未检测 CUDA 是否可用
+_CUDA_MATCHERS = None
+
+# 已上传到显卡的模板 (按模板数组的 id 缓存，同时保存数组本身以免 id 被复用)，
+# 以及按 (方法, 截图尺寸, 模板尺寸) 复用的截图 / 结果 GpuMat 和下载结果的缓冲区
+_CUDA_TEMPLATES = {}
+_CUDA_BUFFERS = {}
+
+
+def capture_screen(bbox=None):
+    """
+    截取屏幕区域，返回 BGRA 排列的 numpy 数组 (高, 宽, 4)，直接引用 mss 的截图缓冲区。
+    bbox 为 (左, 上, 右, 下)，为 None 时截取主显示器全屏。
+    """
+    global _SCT
+    if _SCT is None:
+        _SCT = mss.mss()
+    sct_img = _SCT.grab(bbox if bbox else _SCT.monitors[1])
+    return np.frombuffer(sct_img.raw, dtype=np.uint8).reshape(sct_img.height, sct_img.width, 4)
+
+
+def to_gray(screenshot):
+    """将 BGRA 截图转换为灰度图，写入按尺寸复用的缓冲区 (下一次同尺寸截图会覆盖它)。"""
+    shape = screenshot.shape[:2]
+    gray = _GRAY_BUFFERS.get(shape)
+    if gray is None:
+        gray = np.empty(shape, np.uint8)
+        _GRAY_BUFFERS[shape] = gray
+    return cv2.cvtColor(screenshot, cv2.COLOR_BGRA2GRAY, dst=gray)
+
+
+def get_cuda_matcher(method):
+    """返回指定匹配方法的 CUDA 模板匹配器；未启用 USE_CUDA 或 CUDA 不可用时返回 None。"""
+    global _CUDA_MATCHERS
+    if not USE_CUDA:
+        return None
+    if _CUDA_MATCHERS is None:
+        try:
+            has_cuda = cv2.cuda.getCudaEnabledDeviceCount() > 0
+        except (AttributeError, cv2.error):
+            has_cuda = False
+        if not has_cuda:
+            print("   [提示] 当前 OpenCV 或设备不支持 CUDA，将使用 CPU 匹配。")
+        _CUDA_MATCHERS = {} if has_cuda else False
+    if _CUDA_MATCHERS is False:
+        return None
+    matcher = _CUDA_MATCHERS.get(method)
+    if matcher is None:
+        matcher = cv2.cuda.createTemplateMatching(cv2.CV_8UC1, method)
+        _CUDA_MATCHERS[method] = matcher
+    return matcher
+
+
+def match_template(image, template_image, method=cv2.TM_CCOEFF_NORMED):
+    """
+    执行 cv2.matchTemplate，结果写入按 (方法, 尺寸) 复用的缓冲区 (下一次同尺寸匹配会覆盖它)。
+    启用 USE_CUDA 且设备支持时，改为上传到显卡匹配后再下载结果；模板只上传一次，GpuMat 按尺寸复用。
+    """
+    matcher = get_cuda_matcher(method)
+    if matcher is not None:
+        cached = _CUDA_TEMPLATES.get(id(template_image))
+        if cached is None or cached[0] is not template_image:
+            template_gpu = cv2.cuda_GpuMat()
+            template_gpu.upload(template_image)
+            cached = (template_image, template_gpu)
+            _CUDA_TEMPLATES[id(template_image)] = cached
+        template_gpu = cached[1]
+
+        buffers_key = (method, image.shape[:2], template_image.shape[:2])
+        buffers = _CUDA_BUFFERS.get(buffers_key)
+        if buffers is None:
+            result_shape = (image.shape[0] - template_image.shape[0] + 1, image.shape[1] - template_image.shape[1] + 1)
+            buffers = (cv2.cuda_GpuMat(), cv2.cuda_GpuMat(), np.empty(result_shape, np.float32))
+            _CUDA_BUFFERS[buffers_key] = buffers
+        image_gpu, result_gpu, result = buffers
+        image_gpu.upload(np.ascontiguousarray(image))
+        matcher.match(image_gpu, template_gpu, result_gpu)
+        result_gpu.download(result)
+        return result
+
+    result_shape = (image.shape[0] - template_image.shape[0] + 1, image.shape[1] - template_image.shape[1] + 1)
+    result = _RESULT_BUFFERS.get((method, result_shape))
+    if result is None:
+        result = np.empty(result_shape, np.float32)
+        _RESULT_BUFFERS[(method, result_shape)] = result
+    return cv2.matchTemplate(image, template_image, method, result=result)
+
+
+@functools.lru_cache(maxsize=16)
+def load_template(template_filename):
+    """
+    读取灰度模板并缓存，重复调用 run_test 时不再重新解码 PNG。
+    使用 fromfile + imdecode 以兼容包含中文的路径；读取失败时抛出 ValueError (失败不会被缓存)。
+    """
+    template_image = cv2.imdecode(np.fromfile(template_filename, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if template_image is None:
+        raise ValueError(f"无法解码图片 '{template_filename}'")
+    return template_image
+
+
+def match_template_fft(main_image_gray, template_image):
+    """
+    基于 DFT 的 TM_CCOEFF_NORMED 模板匹配，返回与 cv2.matchTemplate 相同尺寸的相似度图。
+    分子为截图与零均值模板的互相关 (频域相乘)，分母由积分图计算每个窗口的方差。
+    计算量与模板尺寸基本无关，模板较大时比空域滑动匹配快。
+    """
+    main_h, main_w = main_image_gray.shape
+    h, w = template_image.shape
+    dft_h, dft_w = cv2.getOptimalDFTSize(main_h), cv2.getOptimalDFTSize(main_w)
+
+    main_padded = np.zeros((dft_h, dft_w), np.float32)
+    main_padded[:main_h, :main_w] = main_image_gray
+    template_zero_mean = template_image.astype(np.float32) - float(template_image.mean())
+    template_padded = np.zeros((dft_h, dft_w), np.float32)
+    template_padded[:h, :w] = template_zero_mean
+
+    spectrum = cv2.mulSpectrums(cv2.dft(main_padded, flags=cv2.DFT_COMPLEX_OUTPUT),
+                                cv2.dft(template_padded, flags=cv2.DFT_COMPLEX_OUTPUT), 0, conjB=True)
+    numerator = cv2.idft(spectrum, flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)[:main_h - h + 1, :main_w - w + 1]
+
+    # 用积分图计算每个窗口内的像素和与平方和
+    sum_img, sqsum_img = cv2.integral2(main_image_gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    window_sum = sum_img[h:, w:] - sum_img[:-h, w:] - sum_img[h:, :-w] + sum_img[:-h, :-w]
+    window_sqsum = sqsum_img[h:, w:] - sqsum_img[:-h, w:] - sqsum_img[h:, :-w] + sqsum_img[:-h, :-w]
+    window_var = np.maximum(window_sqsum - window_sum ** 2 / (w * h), 0)
+
+    denominator = np.sqrt(window_var * float((template_zero_mean ** 2).sum()))
+    result = np.zeros_like(numerator)
+    valid = denominator > 1e-6
+    result[valid] = numerator[valid] / denominator[valid]
+    return np.clip(result, -1, 1, out=result)
+
+
+def match_coarse_to_fine(main_image_gray, template_image, levels):
+    """
+    金字塔粗到细匹配。先在缩小 2^levels 倍的图像上匹配，
+    再只在粗匹配候选位置附近的原分辨率小区域内精确匹配。
+    返回与 cv2.matchTemplate 相同尺寸的相似度图，未复核的位置填充为 -1。
+    """
+    scale = 1 << levels
+    main_small, template_small = main_image_gray, template_image
+    for _ in range(levels):
+        main_small = cv2.pyrDown(main_small)
+        template_small = cv2.pyrDown(template_small)
+
+    main_h, main_w = main_image_gray.shape
+    h, w = template_image.shape
+    if main_small.shape[0] < template_small.shape[0] or main_small.shape[1] < template_small.shape[1]:
+        return match_template(main_image_gray, template_image)
+
+    # 粗匹配和各候选区域的复核都经由 match_template，复用输出缓冲区 (启用 USE_CUDA 时在显卡上匹配)；
+    # 缓冲区会被下一次同尺寸匹配覆盖，因此候选位置在复核开始前就已提取为列表
+    result_coarse = match_template(main_small, template_small)
+    # 候选位置: 粗匹配相似度图中超过放宽阈值的局部极大值，外加全局最高点 (供未找到目标时展示)
+    is_peak = (result_coarse >= cv2.dilate(result_coarse, None)) & (result_coarse >= CONFIDENCE_THRESHOLD - PYRAMID_THRESHOLD_RELAX)
+    candidates = np.argwhere(is_peak).tolist()
+    _, _, _, (best_x, best_y) = cv2.minMaxLoc(result_coarse)
+    candidates.append([best_y, best_x])
+
+    result = np.full((main_h - h + 1, main_w - w + 1), -1, np.float32)
+    margin = scale + 4
+    for cy, cx in candidates:
+        x1, y1 = max(cx * scale - margin, 0), max(cy * scale - margin, 0)
+        x2, y2 = min(cx * scale + w + margin, main_w), min(cy * scale + h + margin, main_h)
+        roi_result = match_template(main_image_gray[y1:y2, x1:x2], template_image)
+        region = result[y1:y1 + roi_result.shape[0], x1:x1 + roi_result.shape[1]]
+        np.maximum(region, roi_result, out=region)
+    return result
+
+
+def find_local_maxima(result, threshold, w, h):
+    """
+    返回相似度图中不低于阈值的局部极大值坐标列表 [(x, y), ...]，每个极大值对应一个目标
+    (与 Monitor.py 的 count_local_maxima 计数逻辑一致)。
+    一个点只有在以它为中心、约为模板大小 (半径 w/2 × h/2) 的窗口内取得最大值时才被保留。
+    """
+    if result.size == 0 or result.max() < threshold:
+        return []
+    kernel = np.ones((2 * (h // 2) + 1, 2 * (w // 2) + 1), np.uint8)
+    local_max = cv2.dilate(result, kernel)
+    ys, xs = np.nonzero((result >= local_max) & (result >= threshold))
+    # 相似度相同的相邻点 (平台区域) 都会被保留，需要再去重一次
+    return dedupe_points(xs, ys, result[ys, xs], w // 2, h // 2)
+
+
+def dedupe_points(xs, ys, scores, radius_x, radius_y):
+    """
+    基于网格哈希的重复点去除，返回保留的点 [(x, y), ...] (与 Monitor.py 的 dedupe_points 一致)。
+    按相似度从高到低处理，若某点与已保留点的横向距离不超过 radius_x 且纵向距离不超过 radius_y 则丢弃。
+    """
+    cell_x, cell_y = max(radius_x, 1), max(radius_y, 1)
+    grid = {}
+    kept = []
+    for i in np.argsort(-scores, kind='stable'):
+        x, y = int(xs[i]), int(ys[i])
+        cx, cy = x // cell_x, y // cell_y
+        is_duplicate = any(
+            abs(x - px) <= radius_x and abs(y - py) <= radius_y
+            for gx in (cx - 1, cx, cx + 1)
+            for gy in (cy - 1, cy, cy + 1)
+            for px, py in grid.get((gx, gy), ())
+        )
+        if not is_duplicate:
+            grid.setdefault((cx, cy), []).append((x, y))
+            kept.append((x, y))
+    return kept
+
+
+def show_result(image):
+    """弹出窗口显示测试结果图片，按任意键关闭。"""
+    print("\n即将弹出一个名为 'Test Result' 的窗口显示结果...")
+    print("按键盘上的任意键即可关闭窗口并退出程序。")
+    
+    # 创建一个可调整大小的窗口
+    cv2.namedWindow('Test Result', cv2.WINDOW_NORMAL)
+    cv2.imshow('Test Result', image)
+    
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
+    print("--- 测试结束 ---")
+
+
+def run_test(count_only=COUNT_ONLY):
     """
     执行一次查找和可视化测试，现已支持区域截图。
+    count_only 为 False 时只判断目标是否存在，不统计数量。
     """
     print("--- 开始测试 ---")
     
@@ -39,7 +290,7 @@ def run_test():
     if ENABLE_AREA_SEARCH:
         print(f"1. 正在截取指定区域: {SEARCH_AREA_BBOX}...")
         try:
-            screenshot = ImageGrab.grab(bbox=SEARCH_AREA_BBOX)
+            screenshot = capture_screen(SEARCH_AREA_BBOX)
             bbox_offset = SEARCH_AREA_BBOX # 记录偏移量，以便后续坐标转换
         except Exception as e:
             print(f"[错误] 截取指定区域时失败: {e}")
@@ -47,43 +298,71 @@ def run_test():
             return
     else:
         print("1. 正在截取整个屏幕...")
-        screenshot = ImageGrab.grab()
+        screenshot = capture_screen()
         bbox_offset = (0, 0, 0, 0) # 全屏时，偏移量为0
     
-    # 用于显示的彩色原图
-    main_image_for_display = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-    # 用于匹配的灰度图
-    main_image_gray = cv2.cvtColor(main_image_for_display, cv2.COLOR_BGR2GRAY)
+    # 用于匹配的灰度图: 由 BGRA 截图一次转换得到，不经过中间的 BGR 彩色图
+    main_image_gray = to_gray(screenshot)
     print("   截图完成。")
 
     print(f"2. 正在加载模板图片 '{TEMPLATE_FILENAME}'...")
-    template_image = cv2.imread(TEMPLATE_FILENAME, cv2.IMREAD_GRAYSCALE)
-    if template_image is None:
+    try:
+        template_image = load_template(TEMPLATE_FILENAME)
+    except (OSError, ValueError):
         print(f"[错误] 无法读取模板图片 '{TEMPLATE_FILENAME}'。")
         return
     print("   模板加载完成。")
     
     w, h = template_image.shape[::-1]
 
+    if not count_only:
+        # 只关心目标是否存在: 一次 TM_SQDIFF_NORMED 加 minMaxLoc 即可，无需提取和合并所有候选点
+        print("3. 正在进行存在性检查 (TM_SQDIFF_NORMED)...")
+        result = match_template(main_image_gray, template_image, cv2.TM_SQDIFF_NORMED)
+        min_val, _, min_loc, _ = cv2.minMaxLoc(result)
+        similarity = 1 - min_val
+        is_found = similarity >= CONFIDENCE_THRESHOLD
+        print("   运算完成。")
+
+        print(f"\n--- 测试结果 ---")
+        main_image_for_display = cv2.cvtColor(screenshot, cv2.COLOR_BGRA2BGR)
+        print(f"在阈值为 {CONFIDENCE_THRESHOLD} 的情况下，{'找到' if is_found else '未找到'}目标。"
+              f"最佳位置在截图区域内的坐标 {min_loc}，相似度为 {similarity:.4f}")
+        # 找到时画绿框，未找到时用红框标出最相似的位置
+        color = (0, 255, 0) if is_found else (0, 0, 255)
+        cv2.rectangle(main_image_for_display, min_loc, (min_loc[0] + w, min_loc[1] + h), color, 2)
+        show_result(main_image_for_display)
+        return
+
+    # 模板越大可缩小的层数越多；模板太小时直接在原分辨率上匹配
+    levels = 0
+    while levels < PYRAMID_MAX_LEVELS and min(w, h) >> (levels + 1) >= PYRAMID_MIN_TEMPLATE_SIDE:
+        levels += 1
+
     print("3. 正在进行模板匹配运算...")
-    result = cv2.matchTemplate(main_image_gray, template_image, cv2.TM_CCOEFF_NORMED)
+    if levels > 0:
+        print(f"   使用金字塔粗匹配 (缩小 {1 << levels} 倍)，再在候选位置附近精确匹配。")
+        result = match_coarse_to_fine(main_image_gray, template_image, levels)
+    elif w * h > FFT_MIN_TEMPLATE_AREA:
+        print("   模板较大，使用频域 (DFT) 匹配。")
+        result = match_template_fft(main_image_gray, template_image)
+    else:
+        result = match_template(main_image_gray, template_image)
     print("   运算完成。")
 
-    locations = np.where(result >= CONFIDENCE_THRESHOLD)
-    
-    rectangles = []
-    for pt in zip(*locations[::-1]):
-        rectangles.append([int(pt[0]), int(pt[1]), int(w), int(h)])
-        
-    rects_grouped, _ = cv2.groupRectangles(rectangles, groupThreshold=0, eps=0.5)
+    # 与 Monitor.py 相同的计数方式: 相似度图的局部极大值加去重，每个保留点对应一个目标
+    peaks = find_local_maxima(result, CONFIDENCE_THRESHOLD, w, h)
 
-    found_count = len(rects_grouped)
+    found_count = len(peaks)
     print(f"\n--- 测试结果 ---")
+
+    # 用于显示的彩色原图，匹配完成后才需要
+    main_image_for_display = cv2.cvtColor(screenshot, cv2.COLOR_BGRA2BGR)
     print(f"在阈值为 {CONFIDENCE_THRESHOLD} 的情况下，共找到 {found_count} 个目标。")
 
     if found_count > 0:
         print("正在绘制识别结果...")
-        for (x, y, w, h) in rects_grouped:
+        for (x, y) in peaks:
             # 在用于显示的彩色图上画绿框
             cv2.rectangle(main_image_for_display, (x, y), (x + w, y + h), (0, 255, 0), 2)
         print("   绘制完成。")
@@ -95,16 +374,7 @@ def run_test():
         cv2.rectangle(main_image_for_display, max_loc, (max_loc[0] + w, max_loc[1] + h), (0, 0, 255), 2)
         
     # 5. 显示结果图片
-    print("\n即将弹出一个名为 'Test Result' 的窗口显示结果...")
-    print("按键盘上的任意键即可关闭窗口并退出程序。")
-    
-    # 创建一个可调整大小的窗口
-    cv2.namedWindow('Test Result', cv2.WINDOW_NORMAL)
-    cv2.imshow('Test Result', main_image_for_display)
-    
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
-    print("--- 测试结束 ---")
+    show_result(main_image_for_display)
 
 
 # --- 脚本入口 ---